@@ -1,7 +1,11 @@
-from flask import Flask, render_template, request, session, redirect, url_for, send_file
+from flask import Flask, render_template, request, session, redirect, url_for, send_file, g, jsonify
 import os
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google.generativeai import client as genai_client
+import google.ai.generativelanguage as glm
+from google.api_core import gapic_v1
+from google.auth.api_key import Credentials as ApiKeyCredentials
 import json
 from datetime import datetime
 from reportlab.lib.pagesizes import letter
@@ -11,14 +15,162 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak,
 from reportlab.lib import colors
 from io import BytesIO
 import random
+import threading
+import sys
+import time
+import heapq
+import bisect
+from collections import Counter
 
 load_dotenv()
 api_key = os.getenv("GEMINI_API_KEY")
-genai.configure(api_key=api_key)
+
+# Gemini client settings
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+GEMINI_TRANSPORT = os.getenv("GEMINI_TRANSPORT", "")  # "grpc" (default) or "rest"
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT", "")  # e.g. a local stub for benchmarking
+GEMINI_KEEPALIVE_MS = int(os.getenv("GEMINI_KEEPALIVE_MS", "300000"))
+GEMINI_PREWARM = os.getenv("GEMINI_PREWARM", "0") == "1"
+
+
+def load_generation_config():
+    """Read the default generation config from the environment"""
+    generation_config = {}
+    if os.getenv("GEMINI_TEMPERATURE"):
+        generation_config["temperature"] = float(os.getenv("GEMINI_TEMPERATURE"))
+    if os.getenv("GEMINI_TOP_P"):
+        generation_config["top_p"] = float(os.getenv("GEMINI_TOP_P"))
+    if os.getenv("GEMINI_MAX_OUTPUT_TOKENS"):
+        generation_config["max_output_tokens"] = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS"))
+    return generation_config
+
+
+GEMINI_GENERATION_CONFIG = load_generation_config()
+
+
+class KeepaliveGrpcTransport(glm.GenerativeServiceClient.get_transport_class("grpc")):
+    """Generative service gRPC transport whose channel sends keep-alive pings"""
+
+    @classmethod
+    def create_channel(cls, host="generativelanguage.googleapis.com", **kwargs):
+        kwargs["options"] = list(kwargs.get("options") or []) + [
+            ("grpc.keepalive_time_ms", GEMINI_KEEPALIVE_MS),
+            ("grpc.keepalive_timeout_ms", 20000),
+            ("grpc.keepalive_permit_without_calls", 1),
+            ("grpc.http2.max_pings_without_data", 0),
+        ]
+        return super().create_channel(host, **kwargs)
+
+
+# Per-process Gemini client and GenerativeModel instances (keyed by model name
+# and generation config). Every model shares the one client, so requests reuse
+# its connection instead of paying connection and TLS setup again.
+_gemini_client = None
+_gemini_models = {}
+_gemini_models_lock = threading.Lock()
+_gemini_prewarm_pid = None
+
+
+def configure_gemini():
+    options = {"api_key": api_key}
+    if GEMINI_TRANSPORT:
+        options["transport"] = GEMINI_TRANSPORT
+    if GEMINI_API_ENDPOINT:
+        options["client_options"] = {"api_endpoint": GEMINI_API_ENDPOINT}
+    genai.configure(**options)
+
+
+def create_gemini_client():
+    # genai.configure() only accepts a transport name, so the keep-alive gRPC
+    # client is built here; REST keeps connections alive through its HTTP session.
+    if not api_key or GEMINI_TRANSPORT not in ("", "grpc"):
+        return genai_client.get_default_generative_client()
+    transport = KeepaliveGrpcTransport(
+        host=GEMINI_API_ENDPOINT or glm.GenerativeServiceClient.DEFAULT_ENDPOINT,
+        credentials=ApiKeyCredentials(api_key),
+        client_info=gapic_v1.client_info.ClientInfo(user_agent=f"genai-py/{genai.__version__}"),
+        always_use_jwt_access=True
+    )
+    return glm.GenerativeServiceClient(transport=transport)
+
+
+def get_gemini_client():
+    """Return this process's generative service client, creating it on first use"""
+    global _gemini_client
+    with _gemini_models_lock:
+        if _gemini_client is None:
+            _gemini_client = create_gemini_client()
+        return _gemini_client
+
+
+def get_gemini_model(model_name=None, generation_config=None):
+    """Return the cached GenerativeModel for this process, creating it on first use"""
+    model_name = model_name or GEMINI_MODEL_NAME
+    if generation_config is None:
+        generation_config = GEMINI_GENERATION_CONFIG
+    key = (model_name, json.dumps(generation_config, sort_keys=True))
+    gemini_client = get_gemini_client()
+
+    with _gemini_models_lock:
+        model = _gemini_models.get(key)
+        if model is None:
+            model = genai.GenerativeModel(model_name, generation_config=generation_config or None)
+            # generate_content only creates a client when none is set
+            model._client = gemini_client
+            _gemini_models[key] = model
+    return model
+
+
+def prewarm_gemini():
+    """Open the connection to the Gemini endpoint before the first real request"""
+    if not api_key:
+        return
+    try:
+        get_gemini_client().count_tokens(
+            model=get_gemini_model().model_name,
+            contents=[glm.Content(parts=[glm.Part(text="ping")])]
+        )
+    except Exception as e:
+        app.logger.warning("Gemini prewarm failed: %s", e)
+
+
+def start_gemini_prewarm():
+    """Prewarm in the background, once per process.
+
+    Call this from the server's worker-start hook (e.g. gunicorn's post_worker_init)
+    when workers import the app themselves; it never runs in a preloading parent.
+    """
+    global _gemini_prewarm_pid
+    if not GEMINI_PREWARM or _gemini_prewarm_pid == os.getpid():
+        return
+    _gemini_prewarm_pid = os.getpid()
+    threading.Thread(target=prewarm_gemini, daemon=True).start()
+
+
+def reset_gemini_clients():
+    """Drop clients inherited from the parent process and prewarm in the worker"""
+    global _gemini_models_lock, _gemini_client
+    _gemini_models_lock = threading.Lock()
+    _gemini_client = None
+    _gemini_models.clear()
+    configure_gemini()
+    start_gemini_prewarm()
+
+
+# No channel is opened at import time, so a preloading pre-fork server never
+# forks with a live gRPC channel. Prewarm runs after the fork in each worker,
+# from a server's worker-start hook, or at import under the single-process
+# `flask run` dev server (its reloader restarts with a new process, not a fork).
+configure_gemini()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_gemini_clients)
 
 app = Flask(__name__)
 app.secret_key = "your-secret-key-genai-2026"  # Change this in production
 
+if os.environ.get("FLASK_RUN_FROM_CLI") == "true":
+    start_gemini_prewarm()
+
 # Question templates for fallback generation
 QUESTION_TEMPLATES = {
     "2mark": [
@@ -237,7 +389,7 @@ def get_quiz_questions(department, course, count=5):
 
     if api_key:
         try:
-            model = genai.GenerativeModel('gemini-2.0-flash')
+            model = get_gemini_model()
             uniqueness_seed = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             prompt = f"""Generate {count} multiple-choice quiz questions.
 Department: {DEPARTMENTS.get(department, {}).get('name', department)}
@@ -331,6 +483,298 @@ def save_past_papers(papers):
 def is_paper_published_for_students(paper):
     return paper.get("published", True)
 
+
+# Published papers visible to students, partitioned by department and course.
+# Each course list holds (publish_key, paper) tuples sorted oldest publish first.
+_published_index = {}
+# Where each indexed paper sits: id -> (department, course, publish_key)
+_published_locations = {}
+# Per-department versions, derived from the highest publish_seq stored on its papers
+_published_versions = {}
+_published_lock = threading.Lock()
+# (mtime, size) of the store when it was last synced, to pick up other workers' writes
+_published_store_stamp = None
+
+
+def get_publish_time(paper):
+    return paper.get('published_at') or paper.get('date', '')
+
+
+def get_publish_key(paper):
+    return (get_publish_time(paper), paper.get('publish_seq', 0), paper.get('id', 0))
+
+
+def get_next_publish_seq(papers):
+    return max((paper.get('publish_seq', 0) for paper in papers), default=0) + 1
+
+
+def get_store_stamp():
+    try:
+        stat = os.stat(PAST_PAPERS_FILE)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _remove_indexed_paper(paper_id):
+    department, course, _ = _published_locations.pop(paper_id)
+    entries = _published_index[department][course]
+    entries[:] = [entry for entry in entries if entry[1].get('id', 0) != paper_id]
+
+
+def _index_paper(paper):
+    """Add, move or drop one paper in the index; caller holds _published_lock"""
+    paper_id = paper.get('id', 0)
+    department = paper.get('department')
+    location = None
+    if is_paper_published_for_students(paper):
+        location = (department, paper.get('course'), get_publish_key(paper))
+
+    previous = _published_locations.get(paper_id)
+    if previous == location:
+        return
+    if previous is not None:
+        _remove_indexed_paper(paper_id)
+    if location is not None:
+        entries = _published_index.setdefault(department, {}).setdefault(location[1], [])
+        position = bisect.bisect_right([entry[0] for entry in entries], location[2])
+        entries.insert(position, (location[2], paper))
+        _published_locations[paper_id] = location
+        _published_versions[department] = max(_published_versions.get(department, 0), paper.get('publish_seq', 0))
+
+
+def sync_published_index():
+    """Apply changes to the store made since the last sync (e.g. by another worker).
+
+    Only stats the file when nothing changed; otherwise each paper is diffed
+    against its indexed position, so unchanged papers are left in place.
+    """
+    global _published_store_stamp
+    stamp = get_store_stamp()
+    if stamp == _published_store_stamp:
+        return
+    papers = load_past_papers()
+
+    with _published_lock:
+        _published_store_stamp = stamp
+        for paper in papers:
+            _index_paper(paper)
+        stored_ids = {paper.get('id', 0) for paper in papers}
+        for paper_id in [paper_id for paper_id in _published_locations if paper_id not in stored_ids]:
+            _remove_indexed_paper(paper_id)
+
+
+def index_published_paper(paper, stamp_before_save):
+    """Update the index for a paper this process just saved.
+
+    If the store was unchanged since the last sync when we saved, our own write
+    is recorded as synced, so it does not trigger a rescan on the next read.
+    """
+    global _published_store_stamp
+    with _published_lock:
+        _index_paper(paper)
+        if stamp_before_save == _published_store_stamp:
+            _published_store_stamp = get_store_stamp()
+
+
+def get_published_papers(department, course=''):
+    """Published papers for a department (optionally one course), newest publish first"""
+    with _published_lock:
+        courses = _published_index.get(department, {})
+        if course:
+            entries = list(courses.get(course, []))
+        else:
+            entries = list(heapq.merge(*courses.values(), key=lambda entry: entry[0]))
+    return [entry[1] for entry in reversed(entries)]
+
+
+def get_published_version(department):
+    with _published_lock:
+        return _published_versions.get(department, 0)
+
+
+sync_published_index()
+
+
+# Request profiling settings
+PROFILE_ENABLED = os.getenv("GENQ_PROFILE", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.getenv("GENQ_PROFILE_SAMPLE_RATE", "0.01"))
+PROFILE_SLOW_MS = float(os.getenv("GENQ_PROFILE_SLOW_MS", "1000"))
+PROFILE_INTERVAL = float(os.getenv("GENQ_PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_DIR = os.getenv("GENQ_PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("GENQ_PROFILE_KEEP", "50"))
+PROFILE_HEADER = "X-GenQ-Profile"
+PROFILE_ADMINS = [name.strip() for name in os.getenv("GENQ_PROFILE_ADMINS", "").split(",") if name.strip()]
+
+# Stack samples of in-flight requests, keyed by thread id
+_active_profiles = {}
+# Finished requests waiting for the sampler thread to write them to disk
+_pending_captures = []
+_profile_lock = threading.Lock()
+_profile_sampler = None
+# Min-heap of (duration_ms, sequence, capture) holding the slowest captures
+_profile_captures = []
+_profile_sequence = 0
+
+
+def is_profile_admin():
+    return session.get('user') in PROFILE_ADMINS
+
+
+def format_profile_frame(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_request_stacks():
+    """Sampler thread: record stacks of profiled requests and write finished captures.
+
+    Exits once no request is being profiled and nothing is left to write.
+    """
+    global _profile_sampler
+    while True:
+        time.sleep(PROFILE_INTERVAL)
+        with _profile_lock:
+            if not _active_profiles and not _pending_captures:
+                _profile_sampler = None
+                return
+            thread_ids = list(_active_profiles)
+            pending = _pending_captures[:]
+            del _pending_captures[:]
+
+        frames = sys._current_frames()
+        samples = {}
+        for thread_id in thread_ids:
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(format_profile_frame(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                samples[thread_id] = ";".join(reversed(stack))
+        del frames
+
+        with _profile_lock:
+            for thread_id, stack in samples.items():
+                stacks = _active_profiles.get(thread_id)
+                if stacks is not None:
+                    stacks[stack] += 1
+
+        for route, path, duration_ms, stacks in pending:
+            try:
+                save_profile_capture(route, path, duration_ms, stacks)
+            except OSError as e:
+                app.logger.warning("Could not save profile for %s: %s", path, e)
+
+
+def prune_route_profiles(route):
+    """Cap leftover profile files (e.g. from earlier runs) at PROFILE_KEEP per route.
+
+    Files of captures still in the slowest list are removed when they drop out of it.
+    """
+    prefix = f"{route}_"
+    with _profile_lock:
+        listed = {os.path.basename(capture["file"]) for _, _, capture in _profile_captures}
+    files = sorted(
+        name for name in os.listdir(PROFILE_DIR)
+        if name.startswith(prefix) and name.endswith(".folded")
+        and name[len(prefix):len(prefix) + 1].isdigit() and name not in listed
+    )
+    for name in files[:-PROFILE_KEEP]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, name))
+        except OSError:
+            pass
+
+
+def save_profile_capture(route, path, duration_ms, stacks):
+    """Write collapsed stacks for one request to disk and remember it in the slowest list"""
+    global _profile_sequence
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    filename = os.path.join(PROFILE_DIR, f"{route}_{timestamp}_{int(duration_ms)}ms.folded")
+    with open(filename, 'w') as f:
+        for stack, count in stacks.items():
+            f.write(f"{stack} {count}\n")
+
+    self_samples = Counter()
+    for stack, count in stacks.items():
+        self_samples[stack.rsplit(";", 1)[-1]] += count
+
+    capture = {
+        "route": route,
+        "path": path,
+        "duration_ms": round(duration_ms, 1),
+        "samples": sum(stacks.values()),
+        "file": filename,
+        "top_functions": [
+            {"function": function, "samples": count}
+            for function, count in self_samples.most_common(5)
+        ]
+    }
+    with _profile_lock:
+        _profile_sequence += 1
+        entry = (duration_ms, _profile_sequence, capture)
+        dropped = None
+        if len(_profile_captures) < PROFILE_KEEP:
+            heapq.heappush(_profile_captures, entry)
+        else:
+            dropped = heapq.heappushpop(_profile_captures, entry)
+    if dropped is not None:
+        try:
+            os.remove(dropped[2]["file"])
+        except OSError:
+            pass
+    prune_route_profiles(route)
+
+
+@app.before_request
+def start_request_profile():
+    global _profile_sampler
+    forced = request.headers.get(PROFILE_HEADER) == "1"
+    if not PROFILE_ENABLED and not forced:
+        return
+    if forced and not is_profile_admin():
+        forced = False
+        if not PROFILE_ENABLED:
+            return
+
+    g.profile_forced = forced
+    g.profile_started = time.perf_counter()
+    # Register and start the sampler under one lock so it cannot exit in between
+    with _profile_lock:
+        _active_profiles[threading.get_ident()] = Counter()
+        if _profile_sampler is None or not _profile_sampler.is_alive():
+            _profile_sampler = threading.Thread(target=sample_request_stacks, daemon=True)
+            _profile_sampler.start()
+
+
+@app.teardown_request
+def finish_request_profile(exc):
+    started = g.pop('profile_started', None)
+    if started is None:
+        return
+    duration_ms = (time.perf_counter() - started) * 1000
+    keep = (
+        g.pop('profile_forced', False)
+        or duration_ms >= PROFILE_SLOW_MS
+        or random.random() < PROFILE_SAMPLE_RATE
+    )
+    # The sampler thread writes the capture, keeping file I/O off the request
+    with _profile_lock:
+        stacks = _active_profiles.pop(threading.get_ident(), None)
+        if keep and stacks:
+            _pending_captures.append((request.endpoint or "unknown", request.path, duration_ms, stacks))
+
+
+@app.route("/admin/profiles")
+def list_profiles():
+    if 'user' not in session or not is_profile_admin():
+        return redirect(url_for('login'))
+
+    with _profile_lock:
+        captures = [capture for _, _, capture in sorted(_profile_captures, reverse=True)]
+    return jsonify(captures)
+
 @app.route("/")
 def home():
     if 'user' in session:
@@ -415,13 +859,8 @@ def student_dashboard():
     if selected_course and selected_course not in courses:
         selected_course = ''
 
-    papers = load_past_papers()
-    filtered_papers = [
-        paper for paper in papers
-        if paper.get('department') == selected_department and is_paper_published_for_students(paper)
-    ]
-    if selected_course:
-        filtered_papers = [paper for paper in filtered_papers if paper.get('course') == selected_course]
+    sync_published_index()
+    filtered_papers = get_published_papers(selected_department, selected_course)
 
     active_quiz = session.get('active_quiz')
     quiz_result = session.pop('quiz_result', None)
@@ -439,6 +878,22 @@ def student_dashboard():
     )
 
 
+@app.route("/student/papers/version")
+def student_papers_version():
+    if 'user' not in session or session.get('role') != 'student':
+        return redirect(url_for('login'))
+
+    department = request.args.get('department', '').strip()
+    since = request.args.get('since', 0, type=int)
+    sync_published_index()
+    version = get_published_version(department)
+    return jsonify({
+        "department": department,
+        "version": version,
+        "changed": version > since
+    })
+
+
 @app.route("/student/quiz/start", methods=["POST"])
 def start_student_quiz():
     if 'user' not in session or session.get('role') != 'student':
@@ -537,7 +992,10 @@ def publish_paper(paper_id):
             paper['published'] = True
             paper['published_by'] = session.get('name')
             paper['published_at'] = datetime.now().strftime("%Y-%m-%d %H:%M")
+            paper['publish_seq'] = get_next_publish_seq(papers)
+            stamp_before_save = get_store_stamp()
             save_past_papers(papers)
+            index_published_paper(paper, stamp_before_save)
             break
 
     return redirect(url_for('staff_dashboard'))
@@ -571,7 +1029,7 @@ Create:
 Format the response clearly with sections A, B, and C."""
 
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash')
+        model = get_gemini_model()
         response = model.generate_content(prompt)
         output = response.text
     except Exception as e:
@@ -596,7 +1054,9 @@ Format the response clearly with sections A, B, and C."""
             "published": False
         }
         papers.append(paper)
+        stamp_before_save = get_store_stamp()
         save_past_papers(papers)
+        index_published_paper(paper, stamp_before_save)
 
         user_dept = session.get('department', 'AI&DS')
         staff_papers = [item for item in papers if item.get('department') == user_dept]
@@ -716,4 +1176,7 @@ def view_paper(paper_id):
     return redirect(url_for('student_dashboard'))
 
 if __name__ == "__main__":
+    # With debug=True the reloader parent only watches files; prewarm in the serving child
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_gemini_prewarm()
     app.run(debug=True)